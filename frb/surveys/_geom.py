@@ -0,0 +1,45 @@
+""" Compiled kernels for angular separations on the sky """
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True, fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'}, cache=True)
+def haversine(ra1, dec1, ra2, dec2):
+    """
+    Angular separation between an array of positions
+    and a single reference position
+
+    Args:
+        ra1 (ndarray): RA values in radians
+        dec1 (ndarray): DEC values in radians
+        ra2 (float): Reference RA in radians
+        dec2 (float): Reference DEC in radians
+
+    Returns:
+        ndarray: Separations in radians
+    """
+    seps = np.empty(ra1.shape[0])
+    cos_dec2 = np.cos(dec2)
+    for ii in prange(ra1.shape[0]):
+        a = np.sin((dec1[ii]-dec2)/2)**2 + \
+            np.cos(dec1[ii])*cos_dec2*np.sin((ra1[ii]-ra2)/2)**2
+        seps[ii] = 2*np.arcsin(min(np.sqrt(a), 1.))
+    return seps
+
+
+@njit(parallel=True, fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'}, cache=True)
+def radec_to_xyz(ra, dec, out):
+    """
+    Fill an array with the Cartesian unit vectors
+    of a set of positions
+
+    Args:
+        ra (ndarray): RA values in radians
+        dec (ndarray): DEC values in radians
+        out (ndarray): (N,3) array filled in place
+    """
+    for ii in prange(ra.shape[0]):
+        cos_dec = np.cos(dec[ii])
+        out[ii, 0] = cos_dec*np.cos(ra[ii])
+        out[ii, 1] = cos_dec*np.sin(ra[ii])
+        out[ii, 2] = np.sin(dec[ii])
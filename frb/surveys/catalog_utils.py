@@ -1,15 +1,23 @@
 """ Methods related to fussing with a catalog"""
 from astropy.table.table import QTable
 import numpy as np
+import pandas
+from numba import njit
+from scipy.spatial import cKDTree
 
-from astropy.coordinates import SkyCoord
+from astropy.coordinates import Angle
 from astropy.cosmology import Planck18 as cosmo
-from astropy.table import Table, hstack, vstack, setdiff, join
+from astropy.table import Table, Column, MaskedColumn, hstack, vstack, join
 from astropy import units
 from frb.galaxies.defs import valid_filters
+from frb.surveys._geom import haversine, radec_to_xyz
 import warnings
 
-from IPython import embed
+# Error columns of the valid filters, in the same order
+_valid_filter_errs = tuple(filt+"_err" for filt in valid_filters)
+
+# 10**(-x/2.5) = exp(_LN10_NEG_2_5*x)
+_LN10_NEG_2_5 = -np.log(10.)/2.5
 
 
 def clean_heasarc(catalog):
@@ -48,12 +56,80 @@ def clean_cat(catalog, pdict, fill_mask=None):
             catalog.rename_column(value, key)
     # Mask
     if fill_mask is not None:
-        if catalog.mask is not None:
+        if catalog.masked:
+            # Masked tables turn every column back into a MaskedColumn
             catalog = catalog.filled(fill_mask)
+        elif catalog.has_masked_columns:
+            # Only fill the columns with masked entries; the others
+            #  become plain Columns viewing the same data
+            for key in catalog.colnames:
+                col = catalog[key]
+                if not hasattr(col, 'filled'):
+                    continue
+                if np.any(col.mask):
+                    new_col = col.filled(fill_mask)
+                else:
+                    new_col = Column(col.data.data, name=key, unit=col.unit,
+                                     description=col.description, format=col.format,
+                                     meta=col.meta, copy=False)
+                catalog.replace_column(key, new_col, copy=False)
     return catalog
 
 
-def sort_by_separation(catalog, coord, radec=('ra','dec'), add_sep=True):
+def _catalog_radec(catalog, radec=('ra','dec')):
+    """
+    Grab RA/DEC from a catalog as plain arrays, skipping
+    any SkyCoord wrapping
+
+    Args:
+        catalog (astropy.table.Table or QTable): Table of sources
+        radec (tuple, optional): Columns holding RA, DEC.
+            Columns without units are taken to be in deg.
+
+    Returns:
+        tuple: RA, DEC as contiguous float64 ndarrays in radians
+    """
+    return tuple(np.ascontiguousarray(
+        units.Quantity(catalog[key], units.deg, dtype=np.float64).to_value(units.rad))
+                 for key in radec)
+
+
+def _radec_to_cart(ra, dec):
+    """
+    Convert RA/DEC to Cartesian unit vectors on the sphere
+
+    Args:
+        ra (ndarray or float): RA values in radians
+        dec (ndarray or float): DEC values in radians
+
+    Returns:
+        ndarray: (N,3) array of unit vectors
+    """
+    ra = np.atleast_1d(np.asarray(ra, dtype=np.float64))
+    dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+    xyz = np.empty((ra.size, 3))
+    radec_to_xyz(ra, dec, xyz)
+    return xyz
+
+
+def build_cart_tree(catalog, radec=('ra','dec')):
+    """
+    Build a KD-tree on the unit vectors of the sources in a catalog,
+    e.g. to pass as cat2_tree to xmatch_catalogs.
+    Chord distances between unit vectors convert to angular
+    separations as 2*arcsin(chord/2).
+
+    Args:
+        catalog (astropy.table.Table): Table of sources
+        radec (tuple, optional): Columns holding RA, DEC (in deg)
+
+    Returns:
+        scipy.spatial.cKDTree: KD-tree on the unit vectors
+    """
+    return cKDTree(_radec_to_cart(*_catalog_radec(catalog, radec)))
+
+
+def sort_by_separation(catalog, coord, radec=('ra','dec'), add_sep=True, k=None):
     """
     Sort an input catalog by separation from input coordinate
 
@@ -62,6 +138,7 @@ def sort_by_separation(catalog, coord, radec=('ra','dec'), add_sep=True):
         coord (astropy.coordinates.SkyCoord): Reference coordinate for sorting
         radec (tuple): Defines catalog columns holding RA, DEC (in deg)
         add_sep (bool, optional): Add a 'separation' column with units of arcmin
+        k (int, optional): Only return the k closest sources
 
     Returns:
         astropy.table.Table: Sorted catalog
@@ -72,13 +149,17 @@ def sort_by_separation(catalog, coord, radec=('ra','dec'), add_sep=True):
         if key not in catalog.keys():
             print("RA/DEC key: {:s} not in your Table".format(key))
             raise IOError("Try again..")
-    # Grab coords
-    cat_coords = SkyCoord(ra=catalog[radec[0]].data,
-                          dec=catalog[radec[1]].data, unit='deg')
-
     # Separations
-    seps = coord.separation(cat_coords)
-    isrt = np.argsort(seps)
+    ra, dec = _catalog_radec(catalog, radec)
+    seps = haversine(ra, dec, coord.icrs.ra.rad, coord.icrs.dec.rad)
+    if k is not None and k < len(seps):
+        # Partial sort -- only the k closest are ordered
+        part = np.argpartition(seps, k)[:k]
+        isrt = part[np.argsort(seps[part])]
+    else:
+        isrt = np.argsort(seps)
+    seps = seps * units.rad
+
     # Add?
     if add_sep:
         catalog['separation'] = seps.to('arcmin')
@@ -102,20 +183,27 @@ def match_ids(IDs, match_IDs, require_in_match=True):
         ndarray: Rows in match_IDs that match to IDs, aligned -1 if there is no match
 
     """
-    rows = -1 * np.ones_like(IDs).astype(int)
-    # Find which IDs are in match_IDs
-    in_match = np.in1d(IDs, match_IDs)
+    IDs = np.asarray(IDs)
+    match_IDs = np.asarray(match_IDs)
+    if np.all(match_IDs[:-1] <= match_IDs[1:]):
+        # Already sorted -- binary search gives the first instance in match_IDs
+        ypos = np.searchsorted(match_IDs, IDs)
+        in_match = ypos < len(match_IDs)
+        in_match[in_match] = match_IDs[ypos[in_match]] == IDs[in_match]
+        rows = np.where(in_match, ypos, -1)
+    else:
+        # Hash lookup of the input IDs -- first instance in match_IDs only!
+        match_index = pandas.Index(match_IDs)
+        if match_index.is_unique:
+            rows = match_index.get_indexer(IDs)
+        else:
+            first = ~match_index.duplicated(keep='first')
+            rows = match_index[first].get_indexer(IDs)
+            rows = np.where(rows >= 0, np.flatnonzero(first)[rows], -1)
+    # Check
     if require_in_match:
-        if np.sum(~in_match) > 0:
+        if np.any(rows == -1):
             raise IOError("qcat.match_ids: One or more input IDs not in match_IDs")
-    rows[~in_match] = -1
-    #
-    IDs_inmatch = IDs[in_match]
-    # Find indices of input IDs in meta table -- first instance in meta only!
-    xsorted = np.argsort(match_IDs)
-    ypos = np.searchsorted(match_IDs, IDs_inmatch, sorter=xsorted)
-    indices = xsorted[ypos]
-    rows[in_match] = indices
     return rows
 
 
@@ -137,10 +225,12 @@ def summarize_catalog(frbc, catalog, summary_radius, photom_column, magnitude):
     """
     # Init
     summary_list = []
-    coords = SkyCoord(ra=catalog['ra'], dec=catalog['dec'], unit='deg')
+    # Separations from the FRB (haversine, in radians)
+    ra, dec = _catalog_radec(catalog)
+    frb_coord = frbc['coord'].icrs
+    seps = haversine(ra, dec, frb_coord.ra.rad, frb_coord.dec.rad)
     # Find all within the summary radius
-    seps = frbc['coord'].separation(coords)
-    in_radius = seps < summary_radius
+    in_radius = seps < summary_radius.to('rad').value
     # Start summarizing
     summary_list += ['{:s}: There are {:d} source(s) within {:0.1f} arcsec'.format(
         catalog.meta['survey'], np.sum(in_radius), summary_radius.to('arcsec').value)]
@@ -158,7 +248,7 @@ def summarize_catalog(frbc, catalog, summary_radius, photom_column, magnitude):
         closest = np.argmin(seps[in_radius])
         summary_list += ['{:s}: The closest source is at separation {:0.2f} arcsec and has {:s} of {:0.2f}'.format(
             catalog.meta['survey'],
-            seps[in_radius][closest].to('arcsec').value,
+            (seps[in_radius][closest]*units.rad).to('arcsec').value,
             photom_column, catalog[photom_column][in_radius][brightest])]
     # Return
     return summary_list
@@ -167,7 +257,8 @@ def summarize_catalog(frbc, catalog, summary_radius, photom_column, magnitude):
 def xmatch_catalogs(cat1:Table, cat2:Table, skydist:units.Quantity = 5*units.arcsec,
                      RACol1:str = "ra", DecCol1:str = "dec",
                      RACol2:str = "ra", DecCol2:str = "dec",
-                     return_match_idx:bool=False)->tuple:
+                     return_match_idx:bool=False, cat2_tree:cKDTree=None,
+                     return_match_mask:bool=False)->tuple:
     """
     Cross matches two astronomical catalogs and returns
     the matched tables.
@@ -187,31 +278,53 @@ def xmatch_catalogs(cat1:Table, cat2:Table, skydist:units.Quantity = 5*units.arc
         return_match_idx: bool, optional
             Return the indices of the matched entries with
             with the distance instead?
+        cat2_tree: scipy.spatial.cKDTree, optional
+            KD-tree on the cat2 coordinates, built with
+            build_cart_tree(cat2, (RACol2, DecCol2)).
+            Pass it to reuse the tree when matching several
+            catalogs against the same cat2.
+        return_match_mask: bool, optional
+            Return the indices of the nearest entries in cat2
+            with a mask of the cat1 rows matched within skydist
+            instead?
     returns:
         match1, match2: astropy Table
             Tables of matched rows from cat1 and cat2.
         idx, d2d (if return_match_idx): ndarrays
             Indices of matched entries from table 2
             and an array of separations to go with.
+        idx, matched (if return_match_mask): ndarrays
+            Indices of matched entries from table 2 and
+            a boolean mask of the matched rows of table 1.
+            idx is only valid where matched is True.
     """
     assert isinstance(cat1, (Table, QTable))&isinstance(cat1, (Table, QTable)), "Catalogs must be astropy Table instances."
     assert (RACol1 in cat1.colnames)&(DecCol1 in cat1.colnames), " Could not find either {:s} or {:s} in cat1".format(RACol1, DecCol1)
     assert (RACol2 in cat2.colnames)&(DecCol2 in cat2.colnames), " Could not find either {:s} or {:s} in cat2".format(RACol2, DecCol2)
-    # Get corodinates
-    cat1_coord = SkyCoord(cat1[RACol1], cat1[DecCol1], unit = "deg")
-    cat2_coord = SkyCoord(cat2[RACol2], cat2[DecCol2], unit = "deg")
-
-    # Match 2D
-    idx, d2d, _ = cat1_coord.match_to_catalog_sky(cat2_coord)
-
-    # Get matched tables
-    match1 = cat1[d2d < skydist]
-    match2 = cat2[idx[d2d < skydist]]
+    # Get coordinates
+    cat1_cart = _radec_to_cart(*_catalog_radec(cat1, (RACol1, DecCol1)))
+    if cat2_tree is None:
+        cat2_tree = build_cart_tree(cat2, (RACol2, DecCol2))
+    assert cat2_tree.n == len(cat2), "cat2_tree was not built from cat2."
+
+    # Match 2D -- the tree can skip neighbors beyond skydist unless
+    # all the nearest neighbors are requested
+    max_chord = 2*np.sin(skydist.to('rad').value/2)
+    chord, idx = cat2_tree.query(cat1_cart, k=1,
+                                 distance_upper_bound=np.inf if return_match_idx else max_chord)
 
     if return_match_idx:
+        d2d = Angle(2*np.arcsin(np.minimum(chord/2, 1.)), unit=units.rad)
         return idx, d2d
-    else:
-        return match1, match2
+
+    # Get matched tables -- chords increase with separation, so no trig needed
+    matched = chord < max_chord
+    if return_match_mask:
+        return idx, matched
+    match1 = cat1[matched]
+    match2 = cat2[idx[matched]]
+
+    return match1, match2
 
 
 def _detect_mag_cols(photometry_table):
@@ -231,14 +344,12 @@ def _detect_mag_cols(photometry_table):
             in the magnitudes.
     """
     assert type(photometry_table)==Table, "Photometry table must be an astropy Table instance."
-    allcols = photometry_table.colnames
-    photom_cols = np.array(valid_filters)
-    photom_errcols = np.array([filt+"_err" for filt in photom_cols])
+    allcols = set(photometry_table.colnames)
 
-    photom_cols = photom_cols[[elem in allcols for elem in photom_cols]]
-    photom_errcols = photom_errcols[[elem in allcols for elem in photom_errcols]]
+    photom_cols = [filt for filt in valid_filters if filt in allcols]
+    photom_errcols = [filt for filt in _valid_filter_errs if filt in allcols]
     
-    return photom_cols.tolist(), photom_errcols.tolist()
+    return photom_cols, photom_errcols
 
 
 def mag_from_flux(flux, flux_err=None):
@@ -273,36 +384,71 @@ def mag_from_flux(flux, flux_err=None):
         err_mag = None
     return mag_AB, err_mag
 
+@njit(fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'}, cache=True)
+def _mags_to_flux_kernel(mag, mag_err, zpt, flux, flux_err):
+    """
+    Fill flux and flux_err in place from magnitudes.
+    Bad values are set to -99.
+
+    Args:
+        mag (ndarray): 1D array of magnitudes
+        mag_err (ndarray): 1D array of magnitude errors
+        zpt (float): Zero point flux
+        flux (ndarray): 1D output array of fluxes
+        flux_err (ndarray): 1D output array of flux errors
+    """
+    for ii in range(mag.shape[0]):
+        if mag[ii] < -10:
+            flux[ii] = -99.
+            flux_err[ii] = -99.
+            continue
+        flux[ii] = zpt*np.exp(_LN10_NEG_2_5*mag[ii])
+        if (mag_err[ii] < 0) or (mag_err[ii] == 999.):
+            flux_err[ii] = -99.
+        else:
+            flux_err[ii] = flux[ii]*(np.exp(-_LN10_NEG_2_5*mag_err[ii])-1)
+
+
 def _mags_to_flux(mag, zpt_flux:units.Quantity=3630.7805*units.Jy, mag_err=None):
     """
     Convert a magnitude to mJy
 
     Args:
-        mag (column): magnitude
+        mag (column or ndarray): magnitude
         zpt_flux (Quantity, optional): Zero point flux for the magnitude.
             Assumes AB mags by default (i.e. zpt_flux = 3630.7805 Jy). 
-        mag_err (float, optional): uncertainty in magnitude
+        mag_err (column or ndarray, optional): uncertainty in magnitude
     Returns:
-        flux (column): flux in mJy
-        flux_err (column): if mag_err is given, a corresponding
+        flux (ndarray): flux in mJy
+        flux_err (ndarray): if mag_err is given, a corresponding
             flux_err is returned.
+        Both are masked arrays if `mag` or `mag_err` is masked,
+        with masked entries of `mag` masked in both.
     """
     # Data validation -- check for Jy
     assert (type(zpt_flux) == units.Quantity)*(zpt_flux.decompose().unit == units.kg/units.s**2), "zpt_flux units should be Jy or with dimensions kg/s^2."
 
-    # Prepare output column
-    flux = mag.copy()
-
     # Convert fluxes
-    badmags = mag<-10
-    flux[badmags] = -99.
-    flux[~badmags] = zpt_flux.value*10**(-mag[~badmags]/2.5)
+    masked = np.ma.isMaskedArray(mag) or np.ma.isMaskedArray(mag_err)
+    mag_mask = np.ma.getmaskarray(mag)
+    mag = np.asarray(mag, dtype=np.float64)
+    if mag_err is None:
+        errs = np.zeros(mag.shape)
+        err_mask = mag_mask
+    else:
+        errs = np.broadcast_to(np.asarray(mag_err, dtype=np.float64), mag.shape)
+        err_mask = mag_mask | np.ma.getmaskarray(mag_err)
+    flux = np.empty(mag.shape)
+    flux_err = np.empty(mag.shape)
+    _mags_to_flux_kernel(np.ravel(mag), np.ravel(errs), zpt_flux.value,
+                         flux.reshape(-1), flux_err.reshape(-1))
+
+    # Keep masked entries masked
+    if masked:
+        flux = np.ma.MaskedArray(flux, mask=mag_mask)
+        flux_err = np.ma.MaskedArray(flux_err, mask=err_mask)
     
     if mag_err is not None:
-        flux_err = mag_err.copy()
-        baderrs = (mag_err < 0) | (mag_err == 999.)
-        flux_err[baderrs] = -99.
-        flux_err[~baderrs] = flux[~baderrs]*(10**(mag_err[~baderrs]/2.5)-1)
         return flux, flux_err
     else:
         return flux    
@@ -328,31 +474,45 @@ def convert_mags_to_flux(photometry_table, fluxunits='mJy'):
                 are converted to fluxes.
                 For upper limits, the flux is the 3sigma value and
                 the error is set to -99.
+                Masked magnitudes give masked fluxes and errors.
+                Columns that are not converted share their data
+                with `photometry_table`.
     """
-    fluxtable = photometry_table.copy()
     # Find columns with magnitudes based on filter names
-    mag_cols, mag_errcols = _detect_mag_cols(fluxtable)
+    mag_cols, mag_errcols = _detect_mag_cols(photometry_table)
     convert = units.Jy.to(fluxunits)
-
-    for mag, err in zip(mag_cols, mag_errcols):
-        flux, flux_err = _mags_to_flux(photometry_table[mag], 
-                                       mag_err=photometry_table[err])
-
-        # Allow for bad flux values
-        badflux = flux == -99.
-        fluxtable[mag][badflux] = flux[badflux]
-        fluxtable[mag][~badflux] = flux[~badflux]*convert
-
-        # Allow for bad errors
-        baderr = flux_err == -99.0
-        fluxtable[err][baderr] = flux_err[baderr]
-        fluxtable[err][~baderr] = flux_err[~baderr]*convert
-
-        # Upper limits -- Record as 3sigma
-        #   and set error to -99.
-        uplimit = photometry_table[err] == 999.
-        fluxtable[err][uplimit] = -99. #fluxtable[mag][uplimit] / 3.
-        fluxtable[mag][uplimit] = fluxtable[mag][uplimit] 
+    photom_cols = list(zip(mag_cols, mag_errcols))
+
+    # Only copy the data of the columns being converted
+    fluxtable = photometry_table.copy(copy_data=False)
+    if len(photom_cols) == 0:
+        return fluxtable
+    for mag, err in photom_cols:
+        fluxtable.replace_column(mag, photometry_table[mag].copy())
+        fluxtable.replace_column(err, photometry_table[err].copy())
+
+    # Convert all filters at once as (N, F) arrays
+    mags = np.ma.column_stack([photometry_table[mag] for mag, _ in photom_cols])
+    mag_errs = np.ma.column_stack([photometry_table[err] for _, err in photom_cols])
+    fluxes, flux_errs = _mags_to_flux(mags, mag_err=mag_errs)
+    flux_mask = np.ma.getmaskarray(fluxes)
+    err_mask = np.ma.getmaskarray(flux_errs)
+
+    # Convert units, allowing for bad values.  Upper limits
+    #   (err = 999.) already have their error set to -99.
+    fluxes = np.ma.getdata(fluxes)
+    flux_errs = np.ma.getdata(flux_errs)
+    fluxes = np.where(fluxes == -99., fluxes, fluxes*convert)
+    flux_errs = np.where(flux_errs == -99., flux_errs, flux_errs*convert)
+
+    for ii, (mag, err) in enumerate(photom_cols):
+        fluxtable[mag][:] = fluxes[:, ii]
+        fluxtable[err][:] = flux_errs[:, ii]
+        # Carry the input masks over to the fluxes
+        for key, mask in ((mag, flux_mask[:, ii]), (err, err_mask[:, ii])):
+            if mask.any():
+                fluxtable.replace_column(key, MaskedColumn(fluxtable[key], mask=mask, copy=False),
+                                         copy=False)
 
     return fluxtable
 
@@ -369,17 +529,15 @@ def remove_duplicates(tab:Table, idcol:str)->Table:
         idcol (str): A column name that has unique ids
             for each table entry.
     Returns:
-        unique_tab (Table): A table with only the unique ids.
+        unique_tab (Table): A table with only the first entry
+            of each id, in the original order.
     """
-    unique_tab = tab.copy()
-    assert isinstance(unique_tab, Table), "Please provide an astropy table."
+    assert isinstance(tab, Table), "Please provide an astropy table."
     assert isinstance(idcol, str), "Please provide a valid column name."
     assert idcol in tab.colnames, "{} not a column in the given table".format(idcol)
-    # Sort entries first.
-    unique_tab.sort(idcol)
-    # Get the duplicates.
-    duplicate_ids = np.where(unique_tab[1:][idcol]==unique_tab[:-1][idcol])[0]+1
-    unique_tab.remove_rows(duplicate_ids)
+    # Get the first instance of each id; only the id column is sorted.
+    _, first_idx = np.unique(np.asarray(tab[idcol]), return_index=True)
+    unique_tab = tab[np.sort(first_idx)]
     return unique_tab
     
 def xmatch_and_merge_cats(tab1:Table, tab2:Table, tol:units.Quantity=1*units.arcsec,
@@ -403,11 +561,12 @@ def xmatch_and_merge_cats(tab1:Table, tab2:Table, tol:units.Quantity=1*units.arc
         assert len(table_names)==2, "Invalid number of table names for two tables."
         assert (type(table_names[0])==str)&(type(table_names[1])==str), "Table names should be strings."
     
-    assert np.all(np.isin(['ra','dec'],tab1.colnames)), "Table 1 doesn't have column 'ra' and/or 'dec'."
-    assert np.all(np.isin(['ra','dec'],tab2.colnames)), "Table 2 doesn't have column 'ra' and/or 'dec'."
+    assert {'ra','dec'}.issubset(tab1.colnames), "Table 1 doesn't have column 'ra' and/or 'dec'."
+    assert {'ra','dec'}.issubset(tab2.colnames), "Table 2 doesn't have column 'ra' and/or 'dec'."
 
     # Cross-match tables for tab1 INTERSECTION tab2.
-    matched_tab1, matched_tab2 = xmatch_catalogs(tab1, tab2, tol, **kwargs)
+    idx, matched = xmatch_catalogs(tab1, tab2, tol, return_match_mask=True, **kwargs)
+    matched_tab1, matched_tab2 = tab1[matched], tab2[idx[matched]]
 
     # tab1 INTERSECTION tab2
     inner_join = hstack([matched_tab1, matched_tab2],
@@ -422,8 +581,13 @@ def xmatch_and_merge_cats(tab1:Table, tab2:Table, tol:units.Quantity=1*units.arc
     inner_join.rename_columns(tab1_coord_cols, ['ra', 'dec'])
 
     # Now get all objects that weren't matched.
-    not_matched_tab1 = setdiff(tab1, matched_tab1)
-    not_matched_tab2 = setdiff(tab2, matched_tab2)
+    #  Sort them on all columns to keep the row order setdiff gave.
+    not_matched_tab1 = tab1[~matched]
+    not_matched_tab1.sort(tab1.colnames)
+    not_matched2 = np.ones(len(tab2), dtype=bool)
+    not_matched2[idx[matched]] = False
+    not_matched_tab2 = tab2[not_matched2]
+    not_matched_tab2.sort(tab2.colnames)
 
     # (tab1 UNION tab2) - (tab1 INTERSECTION tab2)
 
@@ -442,9 +606,9 @@ def xmatch_and_merge_cats(tab1:Table, tab2:Table, tol:units.Quantity=1*units.arc
     else:
         merged = inner_join
     # Final cleanup. Just in case.
-    weird_cols = np.isin(['ra_1','dec_1','ra_2','dec_2'],merged.colnames)
-    if np.any(weird_cols):
-        merged.remove_columns(np.array(['ra_1','dec_1','ra_2','dec_2'])[weird_cols])
+    weird_cols = [col for col in ['ra_1','dec_1','ra_2','dec_2'] if col in merged.colnames]
+    if len(weird_cols) > 0:
+        merged.remove_columns(weird_cols)
     # Fill and return.
     return merged.filled(-999.)
     
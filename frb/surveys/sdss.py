@@ -114,7 +114,7 @@ class SDSS_Survey(surveycoord.SurveyCoord):
         if photz_cat is not None:
             matches = catalog_utils.match_ids(photz_cat['objid'], photom_catalog['objid'], require_in_match=False)
         else:
-            matches = -1 * np.ones(len(photom_catalog), dtype=int)
+            matches = np.full(len(photom_catalog), -1, dtype=np.intp)
         gdz = matches > 0
         # Init
         photom_catalog['photo_z'] = -9999.
@@ -157,14 +157,13 @@ class SDSS_Survey(surveycoord.SurveyCoord):
         if spec_catalog is not None:
             trim_spec_catalog = trim_down_catalog(spec_catalog)
             # Match
-            spec_coords = SkyCoord(ra=trim_spec_catalog['ra'], dec=trim_spec_catalog['dec'], unit='deg')
-            phot_coords = SkyCoord(ra=trim_catalog['ra'], dec=trim_catalog['dec'], unit='deg')
-            idx, d2d, d3d = match_coordinates_sky(spec_coords, phot_coords, nthneighbor=1)
+            idx, d2d = catalog_utils.xmatch_catalogs(trim_spec_catalog, trim_catalog,
+                                                     return_match_idx=True)
             # Check
             if np.max(d2d).to('arcsec').value > 1.5:
                 raise ValueError("Bad match in SDSS")
             # Fill me
-            zs = -1 * np.ones_like(trim_catalog['ra'].data)
+            zs = np.full(len(trim_catalog), -1.)
             zs[idx] = trim_spec_catalog['z']
             trim_catalog['z_spec'] = zs
         else:
@@ -6,14 +6,15 @@ import astropy
 import pytest
 import os, warnings
 
-from astropy.table import Table
+from astropy.table import Table, QTable, MaskedColumn
 from astropy.coordinates import SkyCoord
 from astropy import units
 from astropy.io.fits.hdu.image import PrimaryHDU
 
-from frb.surveys import survey_utils
+from frb.surveys import survey_utils, catalog_utils
 from PIL import Image
 
+import numpy as np
 from numpy import setdiff1d
 
 remote_data = pytest.mark.skipif(os.getenv('FRB_GDB') is None,
@@ -222,4 +223,239 @@ def test_search_all():
                 'DECaL_ID', 'DECaL_brick', 'gaia_pointsource', 'DECaL_g', 'DECaL_r', 'DECaL_z', 'DECaL_g_err', 'DECaL_r_err', 'DECaL_z_err',
                 'NSC_ID', 'class_star', 'NSC_u', 'NSC_u_err', 'NSC_g', 'NSC_g_err', 'NSC_r', 'NSC_r_err', 'NSC_i', 'NSC_i_err', 'NSC_z', 'NSC_z_err', 'NSC_Y', 'NSC_Y_err', 'NSC_VR', 'NSC_VR_err']
     assert len(setdiff1d(combined_cat.colnames, colnames))==0
-    assert combined_cat['Pan-STARRS_ID'][1] == -999.
\ No newline at end of file
+    assert combined_cat['Pan-STARRS_ID'][1] == -999.
+
+
+def test_sort_by_separation():
+    """
+    Test catalog_utils.sort_by_separation() against SkyCoord
+    """
+    coord = SkyCoord(10.05, -4.95, unit="deg")
+    rng = np.random.default_rng(1234)
+    cat = Table()
+    cat['ra'] = rng.uniform(10., 10.1, 100)
+    cat['dec'] = rng.uniform(-5., -4.9, 100)
+
+    srt_cat = catalog_utils.sort_by_separation(cat, coord)
+    seps = coord.separation(SkyCoord(cat['ra'], cat['dec'], unit="deg"))
+    assert np.allclose(cat['separation'], seps.to('arcmin').value)
+    assert np.all(np.diff(srt_cat['separation']) >= 0.)
+    # Closest few only
+    close_cat = catalog_utils.sort_by_separation(cat, coord, k=5)
+    assert len(close_cat) == 5
+    assert np.all(close_cat['separation'] == srt_cat['separation'][:5])
+    # Reference in another frame
+    srt_cat = catalog_utils.sort_by_separation(cat, coord.galactic)
+    assert np.allclose(cat['separation'], seps.to('arcmin').value)
+    fk4_coord = SkyCoord(10.05, -4.95, unit="deg", frame='fk4')
+    srt_cat = catalog_utils.sort_by_separation(cat, fk4_coord)
+    fk4_seps = fk4_coord.icrs.separation(SkyCoord(cat['ra'], cat['dec'], unit="deg"))
+    assert np.allclose(cat['separation'], fk4_seps.to('arcmin').value)
+
+
+def test_match_ids():
+    """
+    Test catalog_utils.match_ids()
+    """
+    match_IDs = np.array([5, 3, 9, 3, 1])
+    rows = catalog_utils.match_ids(np.array([3, 1, 7]), match_IDs,
+                                   require_in_match=False)
+    assert np.all(rows == [1, 4, -1])
+    # Require a match
+    with pytest.raises(IOError):
+        catalog_utils.match_ids(np.array([3, 7]), match_IDs)
+
+
+def test_xmatch_and_merge_cats():
+    """
+    Test catalog_utils.xmatch_and_merge_cats()
+    """
+    tab1 = Table()
+    tab1['ra'] = [10., 10.01, 10.02]
+    tab1['dec'] = [-5., -5., -5.]
+    tab1['mag1'] = [20., 21., 22.]
+    # One match, one source only in tab2
+    tab2 = Table()
+    tab2['ra'] = [10.03, 10.01 + 1e-5]
+    tab2['dec'] = [-5., -5.]
+    tab2['mag2'] = [23., 24.]
+
+    idx, matched = catalog_utils.xmatch_catalogs(tab1, tab2, 1*units.arcsec,
+                                                 return_match_mask=True)
+    assert np.all(matched == [False, True, False])
+    assert idx[1] == 1
+
+    merged = catalog_utils.xmatch_and_merge_cats(tab1, tab2)
+    assert len(merged) == 4
+    assert merged.colnames == ['ra', 'dec', 'mag1', 'mag2']
+    # Matched entry first
+    assert merged['mag1'][0] == 21. and merged['mag2'][0] == 24.
+    assert np.sum(merged['mag1'] == -999.) == 1
+    assert np.sum(merged['mag2'] == -999.) == 2
+
+
+def test_remove_duplicates():
+    """
+    Test catalog_utils.remove_duplicates()
+    """
+    tab = Table()
+    tab['ID'] = [3, 1, 3, 2, 1]
+    tab['mag'] = [20., 21., 22., 23., 24.]
+
+    unique_tab = catalog_utils.remove_duplicates(tab, 'ID')
+    assert np.all(unique_tab['ID'] == [3, 1, 2])
+    assert np.all(unique_tab['mag'] == [20., 21., 23.])
+
+
+def test_summarize_catalog():
+    """
+    Test catalog_utils.summarize_catalog(), including
+    repeated calls after editing the catalog in place
+    """
+    frbc = {'coord': SkyCoord(10., -5., unit="deg")}
+    cat = Table()
+    cat['ra'] = [10., 10. + 1./3600, 11.]
+    cat['dec'] = [-5., -5., -5.]
+    cat['r'] = [22., 21., 20.]
+    cat.meta['survey'] = 'Test'
+
+    summary = catalog_utils.summarize_catalog(frbc, cat, 5*units.arcsec, 'r', True)
+    assert summary[0] == 'Test: There are 2 source(s) within 5.0 arcsec'
+    assert summary[1] == 'Test: The brightest source has r of 21.00'
+    # FRB coordinate in another frame
+    frbc_gal = {'coord': frbc['coord'].galactic}
+    assert catalog_utils.summarize_catalog(frbc_gal, cat, 5*units.arcsec, 'r', True) == summary
+    # Move every source away
+    cat['ra'][:] = 50.
+    summary = catalog_utils.summarize_catalog(frbc, cat, 5*units.arcsec, 'r', True)
+    assert summary == ['Test: There are 0 source(s) within 5.0 arcsec']
+
+
+def test_clean_cat():
+    """
+    Test catalog_utils.clean_cat() on masked tables and on
+    tables with masked columns
+    """
+    pdict = {'ra': 'RA', 'DES_r': 'mag_r'}
+    for masked in [True, False]:
+        cat = Table(masked=masked)
+        cat['RA'] = [10., 11.]
+        cat['mag_r'] = MaskedColumn([20., 21.], mask=[True, False])
+        cat['flag'] = MaskedColumn([1, 2], unit='dimensionless')
+        flag = cat['flag']
+
+        clean = catalog_utils.clean_cat(cat, pdict, fill_mask=999.)
+        assert clean.colnames == ['ra', 'DES_r', 'flag']
+        assert not clean.masked
+        assert not clean.has_masked_columns
+        assert np.all(clean['DES_r'] == [999., 21.])
+        assert np.all(clean['flag'] == [1, 2])
+        assert clean['flag'].unit == 'dimensionless'
+        if not masked:
+            # Columns without masked entries are not copied
+            assert np.shares_memory(clean['flag'], flag)
+
+
+def test_geom_nan():
+    """
+    NaN positions propagate through the compiled kernels
+    """
+    from frb.surveys import _geom
+    ra = np.deg2rad(np.array([10., np.nan, 10.]))
+    dec = np.deg2rad(np.array([-5., -5., np.nan]))
+    seps = _geom.haversine(ra, dec, np.deg2rad(10.), np.deg2rad(-5.))
+    assert seps[0] == 0.
+    assert np.all(np.isnan(seps[1:]))
+    xyz = np.empty((3, 3))
+    _geom.radec_to_xyz(ra, dec, xyz)
+    assert np.all(np.isfinite(xyz[0])) and np.all(np.isnan(xyz[1:, 0]))
+
+
+def test_xmatch_prebuilt_tree():
+    """
+    Test catalog_utils.xmatch_catalogs() with a prebuilt KD-tree
+    """
+    tab1 = Table()
+    tab1['ra'] = [10., 10.01, 10.02]
+    tab1['dec'] = [-5., -5., -5.]
+    tab2 = Table()
+    tab2['RA'] = [10.02 + 1e-5, 10.03, 10.]
+    tab2['DEC'] = [-5., -5., -5.]
+    tab2['id'] = [1, 2, 3]
+
+    tree = catalog_utils.build_cart_tree(tab2, radec=('RA', 'DEC'))
+    match1, match2 = catalog_utils.xmatch_catalogs(tab1, tab2, RACol2='RA', DecCol2='DEC',
+                                                   cat2_tree=tree)
+    assert np.all(match1['ra'] == [10., 10.02])
+    assert np.all(match2['id'] == [3, 1])
+    # Tree from another table
+    with pytest.raises(AssertionError):
+        catalog_utils.xmatch_catalogs(tab1, tab2[:2], RACol2='RA', DecCol2='DEC',
+                                      cat2_tree=tree)
+
+
+def test_xmatch_qtable_units():
+    """
+    Test catalog_utils.xmatch_catalogs() respects Quantity units
+    """
+    tab1 = QTable()
+    tab1['ra'] = [36000., 36036.]*units.arcsec
+    tab1['dec'] = [-18000., -18000.]*units.arcsec
+    tab2 = Table()
+    tab2['ra'] = [10.01, 10.]
+    tab2['dec'] = [-5., -5.]
+
+    idx, d2d = catalog_utils.xmatch_catalogs(tab1, tab2, return_match_idx=True)
+    assert np.all(idx == [1, 0])
+    assert np.all(d2d.to('arcsec').value < 1e-6)
+
+
+def test_convert_mags_to_flux():
+    """
+    Test catalog_utils.convert_mags_to_flux() for several
+    filters, bad values and upper limits
+    """
+    tab = Table()
+    # good, bad mag with good error, upper limit, negative error, NaN
+    tab['DES_r'] = [20., -999., 21., 22., np.nan]
+    tab['DES_r_err'] = [0.5, 0.1, 999., -1., 0.1]
+    tab['DES_g'] = [21., 20., 20., 20., 20.]
+    tab['DES_g_err'] = [0.1, 0.1, 0.1, 0.1, np.nan]
+    tab['ID'] = np.arange(5)
+
+    fluxtab = catalog_utils.convert_mags_to_flux(tab, fluxunits='mJy')
+
+    # Input is untouched
+    assert tab['DES_r'][0] == 20.
+    assert np.all(fluxtab['ID'] == tab['ID'])
+    # Good values
+    assert np.isclose(fluxtab['DES_r'][0], 0.036307805)
+    assert np.isclose(fluxtab['DES_r_err'][0], 0.02123618797770558)
+    assert np.isclose(fluxtab['DES_g'][0], 0.036307805*10**(-0.4))
+    assert np.isclose(fluxtab['DES_g_err'][0], fluxtab['DES_g'][0]*(10**(0.1/2.5)-1))
+    assert np.allclose(fluxtab['DES_g'][1:], 0.036307805)
+    # Bad mag -- the error is flagged too
+    assert fluxtab['DES_r'][1] == -99.
+    assert fluxtab['DES_r_err'][1] == -99.
+    # Upper limit and negative error
+    assert np.isclose(fluxtab['DES_r'][2], 0.036307805*10**(-0.4))
+    assert fluxtab['DES_r_err'][2] == -99.
+    assert np.isclose(fluxtab['DES_r'][3], 0.036307805*10**(-0.8))
+    assert fluxtab['DES_r_err'][3] == -99.
+    # NaN propagates
+    assert np.isnan(fluxtab['DES_r'][4]) and np.isnan(fluxtab['DES_r_err'][4])
+    assert np.isnan(fluxtab['DES_g_err'][4])
+
+    # Other units
+    fluxtab = catalog_utils.convert_mags_to_flux(tab, fluxunits='uJy')
+    assert np.isclose(fluxtab['DES_r'][0], 36.307805)
+    assert fluxtab['DES_r'][1] == -99.
+
+    # Masked entries stay masked
+    tab['DES_r'] = MaskedColumn([20., 0., 21., 22., 23.], mask=[False, True, False, False, False])
+    tab['DES_r_err'] = MaskedColumn([0.5, 0.1, 0.1, 0.1, 0.1], mask=[False, False, False, False, True])
+    fluxtab = catalog_utils.convert_mags_to_flux(tab, fluxunits='mJy')
+    assert np.all(fluxtab['DES_r'].mask == [False, True, False, False, False])
+    assert np.all(fluxtab['DES_r_err'].mask == [False, True, False, False, True])
+    assert np.isclose(fluxtab['DES_r'][0], 0.036307805)
+    assert not np.any(np.ma.getmaskarray(fluxtab['DES_g']))